@@ -1,7 +1,15 @@
+import asyncio
+from contextlib import contextmanager
 from copy import copy
+import bisect
+import gzip
+import hashlib
+import heapq
+from io import BytesIO
+import time
 import traceback
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands.view import StringView
 import json
 
@@ -9,88 +17,569 @@ from core import checks
 from core.models import DummyMessage, PermissionLevel
 from core.utils import normalize_alias
 
-async def invoke_commands(alias, bot, thread, message):
-    ctxs = []
-    if alias is not None:
-        ctxs = []
-        aliases = normalize_alias(alias)
-        for alias in aliases:
-            view = StringView(bot.prefix + alias)
-            ctx_ = commands.Context(prefix=bot.prefix, view=view, bot=bot, message=message)
-            ctx_.thread = thread
-            discord.utils.find(view.skip_string, await bot.get_prefix())
-            ctx_.invoked_with = view.get_word().lower()
-            ctx_.command = bot.all_commands.get(ctx_.invoked_with)
-            ctxs += [ctx_]
-
-    for ctx in ctxs:
-        if ctx.command:
-            old_checks = copy(ctx.command.checks)
-            ctx.command.checks = [checks.has_permissions(PermissionLevel.INVALID)]
-
-            await bot.invoke(ctx)
-
-            ctx.command.checks = old_checks
-            continue
+class CommandPlan:
+    """A menu command callback, parsed once into the commands it runs."""
+    def __init__(self, alias: str):
+        self.steps = []
+        for alias in normalize_alias(alias):
+            view = StringView(alias)
+            invoked_with = view.get_word().lower()
+            self.steps.append((alias, invoked_with, view.index))
+
+    async def invoke(self, bot, thread, message):
+        for alias, invoked_with, index in self.steps:
+            # looked up on every run, so reloaded commands are picked up
+            command = bot.all_commands.get(invoked_with)
+            if command is None:
+                continue
+            view = StringView(alias)
+            view.index = index
+            ctx = commands.Context(prefix=bot.prefix, view=view, bot=bot, message=message)
+            ctx.thread = thread
+            ctx.invoked_with = invoked_with
+            ctx.command = command
+
+            # menu commands run on behalf of the user and skip the command's checks. reinvoke
+            # does that for this context only, without touching the shared command object
+            bot.dispatch("command", ctx)
+            try:
+                await command.reinvoke(ctx, call_hooks=True)
+            except commands.CommandError as e:
+                bot.dispatch("command_error", ctx, e)
+            except Exception as e:
+                bot.dispatch("command_error", ctx, commands.CommandInvokeError(e))
+            else:
+                bot.dispatch("command_completion", ctx)
 
-class Dropdown(discord.ui.Select):
-    def __init__(self, bot, msg, thread, config: dict, data: dict, is_home: bool):
-        self.bot = bot
-        self.msg = msg
-        self.thread = thread
-        self.config = config
-        self.data = data
+CLOSE_ON_TIMEOUT = CommandPlan("close The menu selection timed out.")
+
+# Option values are sanitized labels, which never contain spaces
+MAIN_MENU = "main menu"
+NEXT_PAGE = "next page"
+PREVIOUS_PAGE = "previous page"
+GO_BACK = "go back"
+
+# discord allows 25 options per select
+MAX_OPTIONS = 25
+
+class MenuNode:
+    """A compiled (sub)menu.
+
+    Holds a copy of the menu's options keyed by sanitized label and the select
+    options built from them, so views can be created without touching the
+    config. Menus with more options than fit in one select are split into
+    pages with next/previous entries.
+    """
+    def __init__(self, key, data: dict, is_home: bool):
+        self.key = key
         self.is_home = is_home
-        options = [
-            discord.SelectOption(label=line["label"], description=line["description"], emoji=line["emoji"]) for line in data.values()
-        ]
-        if not is_home:
-            options.append(discord.SelectOption(label="Main menu", description="Go back to the main menu", emoji="🏠"))
-        super().__init__(placeholder=self.config["dropdown_placeholder"], min_values=1, max_values=1, options=options)
+        self.entries = {k: dict(v) for k, v in data.items()}
+        self.plans = {k: CommandPlan(v["callback"]) for k, v in self.entries.items() if v["type"] == "command"}
+        self.search_index = tuple((f"{line['label']} {line['description']}".lower(), k) for k, line in self.entries.items())
+        options = [self.select_option(k) for k in self.entries]
+
+        main_menu = [] if is_home else [discord.SelectOption(label="Main menu", description="Go back to the main menu", emoji="🏠", value=MAIN_MENU)]
+        if len(options) + len(main_menu) <= MAX_OPTIONS:
+            self.pages = (tuple(options + main_menu),)
+            return
+        # leave room for the main menu, previous page and next page entries
+        size = MAX_OPTIONS - len(main_menu) - 2
+        chunks = [options[i:i + size] for i in range(0, len(options), size)]
+        pages = []
+        for number, chunk in enumerate(chunks):
+            page = list(chunk)
+            if number > 0:
+                page.append(discord.SelectOption(label="Previous page", description=f"Go to page {number} of {len(chunks)}", emoji="⬅️", value=PREVIOUS_PAGE))
+            if number < len(chunks) - 1:
+                page.append(discord.SelectOption(label="Next page", description=f"Go to page {number + 2} of {len(chunks)}", emoji="➡️", value=NEXT_PAGE))
+            pages.append(tuple(page + main_menu))
+        self.pages = tuple(pages)
+
+    def select_option(self, key):
+        line = self.entries[key]
+        return discord.SelectOption(label=line["label"], description=line["description"], emoji=line["emoji"], value=key)
+
+    def search(self, query: str) -> list:
+        """Select options for the entries whose label or description contain every word of the query."""
+        words = query.lower().split()
+        matches = [k for text, k in self.search_index if all(word in text for word in words)]
+        options = [self.select_option(k) for k in matches[:MAX_OPTIONS - 1]]
+        options.append(discord.SelectOption(label="Back", description="Go back to the menu", emoji="↩️", value=GO_BACK))
+        return options
+
+def option_path(menu, option):
+    return f"options.{option}" if menu is None else f"submenus.{menu}.{option}"
+
+class MenuGraph:
+    """All menus of a config compiled into nodes. Rebuilt whenever the config changes.
+
+    While building, it indexes which options refer to each submenu and finds
+    references to missing submenus, submenus that can't be reached from the
+    main menu and cycles between submenus, all in time linear in the number
+    of options.
+    """
+    def __init__(self, config: dict):
+        self.placeholder = config["dropdown_placeholder"]
+        self.home = MenuNode(None, config["options"], True)
+        self.submenus = {k: MenuNode(k, v, False) for k, v in config["submenus"].items()}
+
+        # submenu -> [(menu, option)] of the options that open it, menu is None for the main menu
+        self.referrers = {k: [] for k in self.submenus}
+        self.dangling = []
+        edges = {}
+        for node in [self.home, *self.submenus.values()]:
+            edges[node.key] = []
+            for key, entry in node.entries.items():
+                if entry["type"] != "submenu":
+                    continue
+                if entry["callback"] in self.submenus:
+                    self.referrers[entry["callback"]].append((node.key, key))
+                    edges[node.key].append(entry["callback"])
+                else:
+                    self.dangling.append((node.key, key, entry["callback"]))
+
+        # iterative depth first search from the main menu, a submenu that is
+        # still on the stack when it's reached again closes a cycle
+        self.cycles = []
+        state = {None: 1}
+        stack = [(None, iter(edges[None]))]
+        path = [None]
+        while stack:
+            key, children = stack[-1]
+            child = next(children, False)
+            if child is False:
+                stack.pop()
+                path.pop()
+                state[key] = 2
+            elif state.get(child) == 1:
+                self.cycles.append(path[path.index(child):] + [child])
+            elif child not in state:
+                state[child] = 1
+                stack.append((child, iter(edges[child])))
+                path.append(child)
+        self.unreachable = [k for k in self.submenus if k not in state]
+
+    def problems(self) -> list:
+        problems = [f"`{option_path(menu, option)}` refers to submenu `{target}`, which does not exist." for menu, option, target in self.dangling]
+        problems += [f"Submenu `{k}` can't be reached from the main menu." for k in self.unreachable]
+        problems += [f"Submenus form a cycle: {' -> '.join(cycle)}" for cycle in self.cycles]
+        return problems
+
+class ExpiryScheduler:
+    """Calls `callback(key)` once a key's deadline has passed.
+
+    All open menus share one heap and one task, instead of every view running
+    its own timeout task. Rescheduling or cancelling a key leaves its old heap
+    entry behind, which is skipped when it reaches the top.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        self.deadlines = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def schedule(self, key, deadline: float):
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if self.heap[0] == (deadline, key):
+            self.wakeup.set()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    async def run(self):
+        while True:
+            while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            asyncio.create_task(self.fire(key))
+
+    async def fire(self, key):
+        try:
+            await self.callback(key)
+        except Exception:
+            print(traceback.format_exc())
+
+class Histogram:
+    """Latency histogram with fixed buckets, so recording is cheap and memory is constant."""
+    BOUNDS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+    def __init__(self):
+        self.buckets = [0] * len(self.BOUNDS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms: float):
+        self.buckets[bisect.bisect_left(self.BOUNDS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of samples."""
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+class MenuMetrics:
+    """Counters and latency histograms for menus, kept in memory."""
+    def __init__(self):
+        self.counters = {}
+        self.picks = {}
+        self.timeouts = {}
+        self.latency = {}
+        self.flushed = {}
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def pick(self, menu, option):
+        path = option_path(menu, option)
+        self.picks[path] = self.picks.get(path, 0) + 1
+
+    def timeout(self, menu):
+        menu = menu or "main menu"
+        self.timeouts[menu] = self.timeouts.get(menu, 0) + 1
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if name not in self.latency:
+                self.latency[name] = Histogram()
+            self.latency[name].record((time.perf_counter() - start) * 1000)
+
+    def totals(self) -> dict:
+        """All counts as flat mongo field paths."""
+        def field(key):
+            return str(key).replace(".", "_").replace("$", "_")
+
+        totals = {f"counters.{field(k)}": v for k, v in self.counters.items()}
+        totals.update({f"picks.{field(k)}": v for k, v in self.picks.items()})
+        totals.update({f"timeouts.{field(k)}": v for k, v in self.timeouts.items()})
+        for name, histogram in self.latency.items():
+            totals[f"latency.{field(name)}.count"] = histogram.count
+            totals[f"latency.{field(name)}.total_ms"] = histogram.total
+            for bound, count in zip(histogram.BOUNDS, histogram.buckets):
+                totals[f"latency.{field(name)}.le_{bound}"] = count
+        return totals
+
+    def unflushed(self) -> dict:
+        """Counts added since the last call, for a $inc update."""
+        totals = self.totals()
+        delta = {k: v - self.flushed.get(k, 0) for k, v in totals.items() if v != self.flushed.get(k, 0)}
+        self.flushed = totals
+        return delta
+
+def menu_custom_id(kind, node: MenuNode, page: int = 0):
+    # submenu keys are free text, a digest keeps the id unambiguous and under discord's 100 character limit
+    custom_id = f"advancedmenu:{kind}" if node.is_home else f"advancedmenu:{kind}:{hashlib.sha1(node.key.encode()).hexdigest()[:20]}"
+    return custom_id if not page else f"{custom_id}:{page}"
+
+class Dropdown(discord.ui.Select):
+    def __init__(self, cog, node: MenuNode, page: int = 0, options: list = None):
+        self.cog = cog
+        self.node = node
+        self.page = page
+        if options is None:
+            # the custom id identifies the menu and page, so selections still work after a restart
+            custom_id = menu_custom_id("home" if node.is_home else "submenu", node, page)
+            super().__init__(placeholder=cog.menu.placeholder, min_values=1, max_values=1, options=list(node.pages[page]), custom_id=custom_id)
+        else:
+            # search results, these only live as long as the bot runs
+            super().__init__(placeholder=cog.menu.placeholder, min_values=1, max_values=1, options=options)
 
     async def callback(self, interaction: discord.Interaction):
+        metrics = self.cog.metrics
         try:
-            # await interaction.response.send_message("You selected {}".format(self.values[0]))
-            await interaction.response.defer()
-            await self.view.done()
-            if self.values[0] == "Main menu":
-                await self.msg.edit(view=DropdownView(self.bot, self.msg, self.thread, self.config, self.config["options"], True))
-            elif self.data[self.values[0].lower().replace(" ", "_")]["type"] == "command":
-                await invoke_commands(self.data[self.values[0].lower().replace(" ", "_")]["callback"], self.bot, self.thread, DummyMessage(copy(self.thread._genesis_message)))
-            else:
-                await self.msg.edit(view=DropdownView(self.bot, self.msg, self.thread, self.config, self.config["submenus"][self.data[self.values[0].lower().replace(" ", "_")]["callback"]], False))
+            with metrics.timer("select"):
+                # await interaction.response.send_message("You selected {}".format(self.values[0]))
+                await interaction.response.defer()
+                msg = interaction.message
+                await self.cog.close_menu(msg)
+                thread = await self.cog.bot.threads.find(recipient=interaction.user)
+                if thread is None:
+                    return
+                value = self.values[0]
+                metrics.pick(self.node.key, value)
+                if value == MAIN_MENU:
+                    await self.cog.open_menu(msg, thread, self.cog.menu.home)
+                    return
+                if value in (NEXT_PAGE, PREVIOUS_PAGE, GO_BACK):
+                    page = {NEXT_PAGE: self.page + 1, PREVIOUS_PAGE: self.page - 1, GO_BACK: 0}[value]
+                    await self.cog.open_menu(msg, thread, self.node, min(max(page, 0), len(self.node.pages) - 1))
+                    return
+                entry = self.node.entries[value]
+                if entry["type"] == "command":
+                    metrics.count("commands")
+                    with metrics.timer("command"):
+                        await self.node.plans[value].invoke(self.cog.bot, thread, DummyMessage(copy(await thread.get_genesis_message())))
+                else:
+                    # a missing submenu is reported by `advancedmenu validate`, fall back to the main menu
+                    await self.cog.open_menu(msg, thread, self.cog.menu.submenus.get(entry["callback"], self.cog.menu.home))
         except Exception as e:
+                metrics.count("errors")
                 print(traceback.format_exc())
 
-class DropdownView(discord.ui.View):
-    def __init__(self, bot, msg: discord.Message, thread, config: dict, options: dict, is_home: bool):
-        self.bot = bot
-        self.msg = msg
-        self.thread = thread
-        self.config = config
-        super().__init__(timeout=self.config["timeout"])
-        self.add_item(Dropdown(bot, msg, thread, config, options, is_home))
+class SearchModal(discord.ui.Modal, title="Search"):
+    query = discord.ui.TextInput(label="What are you looking for?", max_length=100)
+
+    def __init__(self, cog, node: MenuNode):
+        super().__init__()
+        self.cog = cog
+        self.node = node
 
-    async def on_timeout(self):
-        await self.msg.edit(view=None)
-        if self.config["close_on_timeout"]:
-            await invoke_commands("close The menu selection timed out.", self.bot, self.thread, DummyMessage(copy(self.thread._genesis_message)))
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            await interaction.response.defer()
+            msg = interaction.message
+            await self.cog.close_menu(msg)
+            thread = await self.cog.bot.threads.find(recipient=interaction.user)
+            if thread is None:
+                return
+            self.cog.metrics.count("searches")
+            await self.cog.open_menu(msg, thread, self.node, options=self.node.search(self.query.value))
+        except Exception:
+            print(traceback.format_exc())
+
+class SearchButton(discord.ui.Button):
+    def __init__(self, cog, node: MenuNode, page: int):
+        super().__init__(label="Search", emoji="🔍", style=discord.ButtonStyle.secondary, custom_id=menu_custom_id("search", node, page))
+        self.cog = cog
+        self.node = node
 
-    async def done(self):
-        self.stop()
-        await self.msg.edit(view=None)
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.send_modal(SearchModal(self.cog, self.node))
+
+class DropdownView(discord.ui.View):
+    def __init__(self, cog, node: MenuNode, page: int = 0, options: list = None):
+        super().__init__(timeout=None)
+        self.add_item(Dropdown(cog, node, page, options))
+        # menus split over several pages can be searched instead of paged through
+        if options is None and len(node.pages) > 1:
+            self.add_item(SearchButton(cog, node, page))
+
+OPTION_FIELDS = ("label", "description", "emoji", "type", "callback")
+
+def validate_config(data, default_config: dict) -> list:
+    """Check a whole config against the expected schema and return every problem found."""
+    if not isinstance(data, dict):
+        return ["The config must be a JSON object."]
+    errors = []
+    for key, default in default_config.items():
+        if key not in data:
+            errors.append(f"Missing key `{key}`.")
+        elif type(data[key]) is not type(default):
+            errors.append(f"`{key}` must be of type {type(default).__name__}.")
+    if errors:
+        return errors
+    if data["timeout"] < 1:
+        errors.append("`timeout` must be at least 1.")
+
+    menus = {"options": data["options"]}
+    for key, submenu in data["submenus"].items():
+        if isinstance(submenu, dict):
+            menus[f"submenus.{key}"] = submenu
+        else:
+            errors.append(f"Submenu `{key}` must be an object.")
+    for menu_path, menu in menus.items():
+        for key, option in menu.items():
+            path = f"{menu_path}.{key}"
+            if not isinstance(option, dict):
+                errors.append(f"`{path}` must be an object.")
+                continue
+            missing = [field for field in OPTION_FIELDS if not isinstance(option.get(field), str)]
+            if missing:
+                errors.append(f"`{path}` is missing or has invalid fields: {', '.join(missing)}.")
+                continue
+            if len(option["description"]) > 100:
+                errors.append(f"`{path}` has a description longer than 100 characters.")
+            if option["type"] not in ("command", "submenu"):
+                errors.append(f"`{path}` has unknown type `{option['type']}`.")
+            elif option["type"] == "submenu" and option["callback"] not in data["submenus"]:
+                errors.append(f"`{path}` refers to submenu `{option['callback']}`, which does not exist.")
+    return errors
+
+class ConfigConflict(Exception):
+    def __init__(self):
+        super().__init__("The config was changed by someone else while you were editing. The latest config has been loaded, please try again.")
+
+class TrackedDict(dict):
+    """A dict that records the path of every key that is set or deleted, including in nested dicts."""
+    def __init__(self, data: dict, changes: set, path: tuple = ()):
+        super().__init__()
+        self._changes = changes
+        self._path = path
+        for key, value in data.items():
+            dict.__setitem__(self, key, self._wrap(key, value))
+
+    def _wrap(self, key, value):
+        if isinstance(value, dict):
+            return TrackedDict(value, self._changes, self._path + (key,))
+        return value
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, self._wrap(key, value))
+        self._changes.add(self._path + (key,))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changes.add(self._path + (key,))
+
+    def pop(self, key, *default):
+        if key in self:
+            self._changes.add(self._path + (key,))
+        return dict.pop(self, key, *default)
+
+class ConfigStore:
+    """Loads and saves the config document, writing only the fields that changed.
+
+    Every save bumps a `_version` field and only applies if the document is
+    still at the version that was loaded, so concurrent edits from another
+    bot process are detected instead of overwritten. Saves within this
+    process are serialized so they don't conflict with each other.
+    """
+    def __init__(self, db, doc_id):
+        self.db = db
+        self.doc_id = doc_id
+        self.lock = asyncio.Lock()
+        self.changes = set()
+        self.version = 0
+        self.data = None
+
+    async def load(self):
+        doc = await self.db.find_one({"_id": self.doc_id})
+        if doc is None:
+            return None
+        doc.pop("_id")
+        self.version = doc.pop("_version", 0)
+        self.replace(doc)
+        self.changes.clear()
+        return self.data
+
+    def replace(self, data: dict):
+        self.data = TrackedDict({k: v for k, v in data.items() if k not in ("_id", "_version")}, self.changes)
+        self.changes.add(())
+
+    def field(self, path: tuple):
+        # mongo can't address keys containing dots or starting with $, so set their parent instead
+        for i, key in enumerate(path):
+            if "." in key or key.startswith("$"):
+                return path[:i]
+        return path
+
+    def update_document(self, changes):
+        """Turn the recorded changes into $set/$unset operations on the smallest changed fields."""
+        paths = []
+        for path in sorted({self.field(path) for path in changes}, key=len):
+            if not any(path[:len(parent)] == parent for parent in paths):
+                paths.append(path)
+
+        to_set, to_unset = {}, {}
+        for path in paths:
+            if not path:
+                to_set.update(self.data)
+                continue
+            value = self.data
+            for key in path:
+                if not isinstance(value, dict) or key not in value:
+                    to_unset[".".join(path)] = ""
+                    break
+                value = value[key]
+            else:
+                to_set[".".join(path)] = value
+        return to_set, to_unset
+
+    async def save(self):
+        async with self.lock:
+            if not self.changes:
+                return
+            # changes made while this save is in flight are left for the next one
+            changes = set(self.changes)
+            self.changes.clear()
+            try:
+                await self.write(changes)
+            except ConfigConflict:
+                raise
+            except Exception:
+                self.changes.update(changes)
+                raise
+
+    async def write(self, changes):
+        to_set, to_unset = self.update_document(changes)
+        update = {"$inc": {"_version": 1}}
+        if to_set:
+            update["$set"] = to_set
+        if to_unset:
+            update["$unset"] = to_unset
+        query = {"_id": self.doc_id, "_version": self.version}
+        if self.version == 0:
+            # documents from before versioning don't have the field yet
+            query["_version"] = {"$in": [0, None]}
+
+        result = await self.db.find_one_and_update(query, update)
+        if result is None:
+            if await self.db.find_one({"_id": self.doc_id}) is not None:
+                await self.load()
+                raise ConfigConflict()
+            await self.db.find_one_and_update({"_id": self.doc_id}, {"$set": {**self.data, "_version": 1}}, upsert=True)
+            self.version = 1
+        else:
+            self.version += 1
 
 class AdvancedMenu(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.db = self.bot.plugin_db.get_partition(self)
         self.config = None
+        self.store = ConfigStore(self.db, "advanced-menu")
+        self.menu = None
+        # persistent views registered with the bot, one per menu
+        self.persistent_views = []
+        # menus opened by this process, by message id
+        self.open_views = {}
+        # every open menu, including ones opened before a restart, by message id
+        self.open_menus = {}
+        # open-menus changes not yet written, by message id, None meaning closed
+        self.menu_writes = {}
+        self.menu_writer = None
+        self.expiry = ExpiryScheduler(self.expire_menu)
+        self.metrics = MenuMetrics()
+        self.persist_metrics = False
         self.default_config = {"enabled": False, "options": {}, "submenus": {}, "timeout": 20, "close_on_timeout": False, "anonymous_menu": False, "embed_text": "Please select an option.", "dropdown_placeholder": "Select an option to contact the staff team."}
 
     async def cog_load(self):
-        self.config = await self.db.find_one({"_id": "advanced-menu"})
+        self.config = await self.store.load()
         if self.config is None:
-            self.config = self.default_config
+            self.store.replace(self.default_config)
+            self.config = self.store.data
             await self.update_config()
         missing = []
         for key in self.default_config.keys():
@@ -103,12 +592,128 @@ class AdvancedMenu(commands.Cog):
 
         await self.update_config()
 
+        open_menus = await self.db.find_one({"_id": "open-menus"}) or {}
+        for message_id, menu in open_menus.get("menus", {}).items():
+            self.open_menus[int(message_id)] = menu
+            self.expiry.schedule(int(message_id), menu["deadline"])
+        self.expiry.start()
+
+        metrics = await self.db.find_one({"_id": "metrics"}) or {}
+        self.persist_metrics = metrics.get("enabled", False)
+        self.flush_metrics.start()
+
+    async def cog_unload(self):
+        self.expiry.stop()
+        self.flush_metrics.cancel()
+        await self.save_metrics()
+        if self.menu_writer is not None:
+            await self.menu_writer
+        for view in self.persistent_views + list(self.open_views.values()):
+            view.stop()
+
+    def register_views(self):
+        """Register a persistent view for every menu so selections on old messages are handled."""
+        for view in self.persistent_views:
+            view.stop()
+        self.persistent_views = [
+            DropdownView(self, node, page)
+            for node in [self.menu.home, *self.menu.submenus.values()]
+            for page in range(len(node.pages))
+        ]
+        for view in self.persistent_views:
+            self.bot.add_view(view)
+
+    async def save_metrics(self):
+        if not self.persist_metrics:
+            return
+        delta = self.metrics.unflushed()
+        if delta:
+            await self.db.find_one_and_update({"_id": "metrics"}, {"$inc": delta}, upsert=True)
+
+    @tasks.loop(minutes=5)
+    async def flush_metrics(self):
+        try:
+            await self.save_metrics()
+        except Exception:
+            print(traceback.format_exc())
+
+    async def open_menu(self, msg: discord.Message, thread, node: MenuNode, page: int = 0, options: list = None):
+        view = DropdownView(self, node, page, options)
+        with self.metrics.timer("menu_edit"):
+            await msg.edit(view=view)
+        self.open_views[msg.id] = view
+        menu = {"channel_id": msg.channel.id, "recipient_id": thread.recipient.id, "node": node.key, "deadline": time.time() + self.config["timeout"]}
+        self.open_menus[msg.id] = menu
+        self.expiry.schedule(msg.id, menu["deadline"])
+        self.write_menu(msg.id, menu)
+
+    async def close_menu(self, msg: discord.Message):
+        self.expiry.cancel(msg.id)
+        view = self.open_views.pop(msg.id, None)
+        if view is not None:
+            view.stop()
+        if self.open_menus.pop(msg.id, None) is not None:
+            self.write_menu(msg.id, None)
+        try:
+            await msg.edit(view=None)
+        except (discord.NotFound, discord.Forbidden):
+            # the message is gone or can't be reached anymore, there's no menu left to remove
+            pass
+
+    def write_menu(self, message_id: int, menu):
+        """
+        Record an open menu, or its closing with None, in the background.
+
+        Selections don't wait on the database. Changes made while a write is in
+        flight are collected into the next single update, keeping only the latest
+        change per message.
+        """
+        self.menu_writes[message_id] = menu
+        if self.menu_writer is None or self.menu_writer.done():
+            self.menu_writer = asyncio.create_task(self.flush_menu_writes())
+
+    async def flush_menu_writes(self):
+        while self.menu_writes:
+            writes, self.menu_writes = self.menu_writes, {}
+            update = {}
+            for message_id, menu in writes.items():
+                if menu is None:
+                    update.setdefault("$unset", {})[f"menus.{message_id}"] = ""
+                else:
+                    update.setdefault("$set", {})[f"menus.{message_id}"] = menu
+            try:
+                await self.db.find_one_and_update({"_id": "open-menus"}, update, upsert=True)
+            except Exception:
+                print(traceback.format_exc())
+                # keep anything not superseded for the next write
+                self.menu_writes = {**writes, **self.menu_writes}
+                return
+
+    async def expire_menu(self, message_id: int):
+        menu = self.open_menus.get(message_id)
+        if menu is None:
+            return
+        self.metrics.timeout(menu.get("node"))
+        with self.metrics.timer("timeout"):
+            msg = self.bot.get_partial_messageable(menu["channel_id"]).get_partial_message(message_id)
+            await self.close_menu(msg)
+            if self.config["close_on_timeout"]:
+                thread = await self.bot.threads.find(recipient_id=menu["recipient_id"])
+                if thread is not None:
+                    await CLOSE_ON_TIMEOUT.invoke(self.bot, thread, DummyMessage(copy(await thread.get_genesis_message())))
+
     async def update_config(self):
-        await self.db.find_one_and_update(
-            {"_id": "advanced-menu"},
-            {"$set": self.config},
-            upsert=True,
-        )
+        try:
+            await self.store.save()
+        finally:
+            # on a conflict the store reloads the latest config
+            self.config = self.store.data
+            self.menu = MenuGraph(self.config)
+            self.register_views()
+
+    async def cog_command_error(self, ctx, error):
+        if isinstance(getattr(error, "original", error), ConfigConflict):
+            await ctx.send(str(error.original))
 
     @commands.Cog.listener()
     async def on_thread_ready(self, thread, creator, category, initial_message):
@@ -123,15 +728,18 @@ class AdvancedMenu(commands.Cog):
             dummyMessage.embeds = []
             dummyMessage.stickers = []
 
-            msgs, _ = await thread.reply(dummyMessage, self.config["anonymous_menu"])
-            main_recipient_msg = None
+            self.metrics.count("menus_sent")
+            with self.metrics.timer("send"):
+                with self.metrics.timer("send_reply"):
+                    msgs, _ = await thread.reply(dummyMessage, self.config["anonymous_menu"])
+                main_recipient_msg = None
 
-            for m in msgs:
-                if m.channel.recipient == thread.recipient:
-                    main_recipient_msg = m
-                    break
+                for m in msgs:
+                    if m.channel.recipient == thread.recipient:
+                        main_recipient_msg = m
+                        break
 
-            await main_recipient_msg.edit(view=DropdownView(self.bot, main_recipient_msg, thread, self.config, self.config["options"], True))
+                await self.open_menu(main_recipient_msg, thread, self.menu.home)
 
     @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
     @commands.group(invoke_without_command=True)
@@ -242,15 +850,13 @@ class AdvancedMenu(commands.Cog):
     @advancedmenu_option.command(name="add")
     async def advancedmenu_option_add(self, ctx):
         """Add an option to the advanced menu."""
+        version = self.store.version
         def check(m):
             return m.author == ctx.author and m.channel == ctx.channel
 
         def typecheck(m):
             return m.author == ctx.author and m.channel == ctx.channel and m.content.lower() in ["command", "submenu"]
 
-        if len(self.config["options"]) >= 25:
-            return await ctx.send("You can only have a maximum of 25 options due to discord limitations.")
-
         await ctx.send("You can type `cancel` at any time to cancel the process.")
         await ctx.send("What is the label of the option?")
         label = (await self.bot.wait_for("message", check=check)).content
@@ -298,6 +904,9 @@ class AdvancedMenu(commands.Cog):
         if type == "submenu" and callback not in self.config["submenus"]:
             return await ctx.send("That submenu does not exist. Use `advancedmenu submenu create` to add it.")
 
+        if self.store.version != version:
+            return await ctx.send("The config was changed while you were editing, please try again.")
+
         self.config["options"][sanitized_label] = {
             "label": label,
             "description": description,
@@ -324,6 +933,7 @@ class AdvancedMenu(commands.Cog):
     @advancedmenu_option.command(name="edit")
     async def advancedmenu_option_edit(self, ctx, *, label):
         """Edit an option from the advanced menu."""
+        version = self.store.version
         label = label.lower().replace(" ", "_")
         if label not in self.config["options"]:
             return await ctx.send("That option does not exist.")
@@ -370,6 +980,9 @@ class AdvancedMenu(commands.Cog):
         if type == "submenu" and callback not in self.config["submenus"]:
             return await ctx.send("That submenu does not exist. Use `advancedmenu submenu create` to add it.")
 
+        if self.store.version != version:
+            return await ctx.send("The config was changed while you were editing, please try again.")
+
         old_label = self.config["options"][label]["label"]
         self.config["options"][label] = {
             "label": old_label,
@@ -408,9 +1021,67 @@ class AdvancedMenu(commands.Cog):
         if label not in self.config["submenus"]:
             return await ctx.send("That submenu does not exist.")
 
+        referrers = self.menu.referrers.get(label, [])
+        if referrers:
+            version = self.store.version
+            paths = ", ".join(f"`{option_path(menu, option)}`" for menu, option in referrers)
+            await ctx.send(f"That submenu is used by {paths}. Send `yes` to delete it together with those options, anything else to cancel.")
+            reply = (await self.bot.wait_for("message", check=lambda m: m.author == ctx.author and m.channel == ctx.channel)).content
+            if reply.lower() != "yes":
+                return await ctx.send("Cancelled.")
+            if self.store.version != version:
+                return await ctx.send("The config was changed while you were editing, please try again.")
+            for menu, option in referrers:
+                if menu is None:
+                    del self.config["options"][option]
+                elif menu != label:
+                    del self.config["submenus"][menu][option]
+
         del self.config["submenus"][label]
         await self.update_config()
-        await ctx.send("Submenu deleted.")
+        await ctx.send("Submenu deleted." if not referrers else f"Submenu deleted along with {len(referrers)} options.")
+
+    @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
+    @advancedmenu.group(name="stats", invoke_without_command=True)
+    async def advancedmenu_stats(self, ctx):
+        """Show menu usage and latency since the bot started."""
+        metrics = self.metrics
+        embed = discord.Embed(title="Advanced menu stats", color=discord.Color.blurple())
+        counters = "\n".join(f"{k}: {v}" for k, v in sorted(metrics.counters.items()))
+        embed.add_field(name="Counters", value=counters or "None", inline=False)
+        latency = "\n".join(
+            f"{name}: n={h.count} avg={h.total / h.count:.0f}ms p50≤{h.percentile(0.5):.0f}ms p95≤{h.percentile(0.95):.0f}ms max={h.max:.0f}ms"
+            for name, h in sorted(metrics.latency.items())
+        )
+        embed.add_field(name="Latency", value=latency[:1024] or "None", inline=False)
+        picks = "\n".join(f"{k}: {v}" for k, v in sorted(metrics.picks.items(), key=lambda item: item[1], reverse=True)[:10])
+        embed.add_field(name="Most picked options", value=picks[:1024] or "None", inline=False)
+        timeouts = "\n".join(f"{k}: {v}" for k, v in sorted(metrics.timeouts.items(), key=lambda item: item[1], reverse=True)[:10])
+        embed.add_field(name="Timeouts by menu", value=timeouts[:1024] or "None", inline=False)
+        embed.set_footer(text=f"Saving to the database is {'enabled' if self.persist_metrics else 'disabled'}")
+        await ctx.send(embed=embed)
+
+    @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
+    @advancedmenu_stats.command(name="persist")
+    async def advancedmenu_stats_persist(self, ctx, option: bool):
+        """Set whether stats are added to the database every 5 minutes"""
+        self.persist_metrics = option
+        # only count from now on, not what was collected while saving was off
+        self.metrics.unflushed()
+        await self.db.find_one_and_update({"_id": "metrics"}, {"$set": {"enabled": option}}, upsert=True)
+        await ctx.send("Done.")
+
+    @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
+    @advancedmenu.command(name="validate")
+    async def advancedmenu_validate(self, ctx):
+        """Check the menus for missing or unreachable submenus and cycles."""
+        problems = self.menu.problems()
+        if not problems:
+            return await ctx.send("No problems found.")
+        message = "Found the following problems:\n" + "\n".join(problems)
+        if len(message) > 2000:
+            message = message[:1997] + "..."
+        await ctx.send(message)
 
     @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
     @advancedmenu_submenu.command(name="list")
@@ -478,6 +1149,7 @@ class AdvancedMenu(commands.Cog):
     @advancedmenu_submenu_option.command(name="add")
     async def advancedmenu_submenu_option_add(self, ctx, *, submenu: str):
         """Add an option to the advanced submenu."""
+        version = self.store.version
         def check(m):
             return m.author == ctx.author and m.channel == ctx.channel
 
@@ -489,9 +1161,6 @@ class AdvancedMenu(commands.Cog):
         if submenu not in self.config["submenus"]:
             return await ctx.send("That submenu does not exist.")
 
-        if len(self.config["submenus"][submenu]) >= 24:
-            return await ctx.send("You can only have a maximum of 24 options due to discord limitations.")
-
         await ctx.send("You can send `cancel` at any time to cancel the process.")
         await ctx.send("What is the label of the option?")
         label = (await self.bot.wait_for("message", check=check)).content
@@ -539,6 +1208,9 @@ class AdvancedMenu(commands.Cog):
         if type == "submenu" and callback not in self.config["submenus"]:
             return await ctx.send("That submenu does not exist. Use `advancedmenu submenu create` to add it.")
 
+        if self.store.version != version:
+            return await ctx.send("The config was changed while you were editing, please try again.")
+
         self.config["submenus"][submenu][sanitized_label] = {
             "label": label,
             "description": description,
@@ -553,6 +1225,7 @@ class AdvancedMenu(commands.Cog):
     @advancedmenu_submenu_option.command(name="remove")
     async def advancedmenu_submenu_option_remove(self, ctx, *, submenu: str):
         """Remove an option from the advanced submenu."""
+        version = self.store.version
         submenu = submenu.lower().replace(" ", "_")
         def check(m):
             return m.author == ctx.author and m.channel == ctx.channel
@@ -568,6 +1241,9 @@ class AdvancedMenu(commands.Cog):
         if label not in self.config["submenus"][submenu]:
             return await ctx.send("That option does not exist.")
 
+        if self.store.version != version:
+            return await ctx.send("The config was changed while you were editing, please try again.")
+
         del self.config["submenus"][submenu][label]
         await self.update_config()
         await ctx.send("Option removed.")
@@ -576,6 +1252,7 @@ class AdvancedMenu(commands.Cog):
     @advancedmenu_submenu_option.command(name="edit")
     async def advancedmenu_submenu_option_edit(self, ctx, *, submenu: str):
         """Edit an option from the advanced submenu."""
+        version = self.store.version
         submenu = submenu.lower().replace(" ", "_")
         def check(m):
             return m.author == ctx.author and m.channel == ctx.channel
@@ -632,6 +1309,9 @@ class AdvancedMenu(commands.Cog):
         if type == "submenu" and callback not in self.config["submenus"]:
             return await ctx.send("That submenu does not exist.")
 
+        if self.store.version != version:
+            return await ctx.send("The config was changed while you were editing, please try again.")
+
         self.config["submenus"][submenu][label]["description"] = description
         self.config["submenus"][submenu][label]["emoji"] = emoji
         self.config["submenus"][submenu][label]["type"] = type
@@ -659,13 +1339,19 @@ class AdvancedMenu(commands.Cog):
 
     @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
     @advancedmenu.command(name="dump_config")
-    async def advancedmenu_dump_config(self, ctx):
-        """Dump the config to chat"""
+    async def advancedmenu_dump_config(self, ctx, *flags):
+        """Dump the config to chat
 
-        with open("config.json", "w") as f:
-            json.dump(self.config, f, indent=4)
+        Add `compact` to leave out indentation and `gzip` to compress the file, for large menus.
+        """
+        compact = "compact" in flags
+        data = json.dumps(self.config, indent=None if compact else 4, separators=(",", ":") if compact else None).encode("utf-8")
+        filename = "config.json"
+        if "gzip" in flags:
+            data = gzip.compress(data)
+            filename += ".gz"
 
-        await ctx.send(file=discord.File("config.json"))
+        await ctx.send(file=discord.File(BytesIO(data), filename=filename))
 
     @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
     @advancedmenu.command(name="load_config")
@@ -676,24 +1362,26 @@ class AdvancedMenu(commands.Cog):
         if not ctx.message.attachments:
             return await ctx.send("You must attach a json file to load the config from.")
         b = await ctx.message.attachments[0].read()
-        json_data = b.decode("utf-8")
 
         # Load json and validate it
         try:
-            data = json.loads(json_data)
-        except json.decoder.JSONDecodeError:
+            if b[:2] == b"\x1f\x8b":
+                b = gzip.decompress(b)
+            data = json.loads(b.decode("utf-8"))
+        except (OSError, EOFError, UnicodeDecodeError, json.decoder.JSONDecodeError):
             return await ctx.send("Invalid json file.")
 
-        # validate json format against default config
-        for key in self.default_config.keys():
-            missing_keys = []
-            if key not in data:
-                missing_keys.append(key)
-            if len(missing_keys) > 0:
-                return await ctx.send("The following keys are missing from the config: " + ", ".join(missing_keys))
+        # validate the whole config, including submenu references, before touching the current one
+        errors = validate_config(data, self.default_config)
+        if errors:
+            message = "The config was not loaded because of the following problems:\n" + "\n".join(errors)
+            if len(message) > 2000:
+                message = message[:1997] + "..."
+            return await ctx.send(message)
 
         # push new config to bot
-        self.config = data
+        self.store.replace(data)
+        self.config = self.store.data
         await self.update_config()
         await ctx.send("Successfully loaded config")
 
@@ -1,10 +1,440 @@
+import aiohttp
+import asyncio
+from collections import deque
+from copy import deepcopy
 import discord
+from io import BytesIO
 from discord.ext import commands, tasks
+import json
 import re
+import sys
+import time
+import unicodedata
 
 from core import checks
 from core.models import PermissionLevel
 
+# JSON imports are parsed in one piece, this bounds how much of one is held in memory.
+MAX_JSON_IMPORT_SIZE = 8 * 1024 * 1024
+
+# Runs in a separate interpreter so a catastrophically backtracking pattern can
+# be killed instead of stalling the bot. Reads {"patterns": [...], "corpus": [...]}
+# on stdin and writes one JSON line per pattern as soon as it is timed.
+PATTERN_TIMER_SCRIPT = r"""
+import json, re, sys, time
+
+def adversarial(pattern):
+    chars = list(dict.fromkeys(c for c in pattern if c.isalnum() or c in " _-."))[:8] or ["a"]
+    inputs = []
+    for c in chars:
+        for n in (8, 16, 32):
+            inputs.append(c * n + "!")
+    for a, b in zip(chars, chars[1:]):
+        inputs.append((a + b) * 16 + "!")
+    return inputs
+
+data = json.load(sys.stdin)
+for pattern in data["patterns"]:
+    try:
+        compiled = re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        print(json.dumps({"error": f"invalid regex: {e}"}), flush=True)
+        continue
+    except Exception as e:
+        # e.g. OverflowError for repeat counts re can't handle
+        print(json.dumps({"error": f"invalid regex: {type(e).__name__}: {e}"}), flush=True)
+        continue
+    worst = total = 0.0
+    inputs = data["corpus"] + adversarial(pattern)
+    try:
+        for text in inputs:
+            start = time.perf_counter()
+            compiled.fullmatch(text)
+            elapsed = time.perf_counter() - start
+            total += elapsed
+            worst = max(worst, elapsed)
+    except Exception as e:
+        print(json.dumps({"error": f"failed to match: {type(e).__name__}: {e}"}), flush=True)
+        continue
+    print(json.dumps({"error": None, "worst": worst, "mean": total / len(inputs)}), flush=True)
+"""
+
+# Inputs every pattern is timed against, on top of recently seen names/messages
+SAMPLE_CORPUS = [
+    "",
+    "hello",
+    "Hello everyone!",
+    "can someone help me with my account?",
+    "https://discord.gg/invite",
+    "user_1234",
+    "xX_Gamer_Xx",
+    "a" * 200,
+    "lorem ipsum dolor sit amet " * 20,
+]
+
+async def time_patterns(patterns, corpus, timeout=2.0):
+    """Time each pattern in a subprocess.
+
+    Returns one dict per pattern with either an "error" or the "worst" and
+    "mean" seconds per match. A pattern that doesn't finish within `timeout`,
+    or that takes the process down, is reported as an error and the remaining
+    patterns are retried in a new process.
+    """
+    results = []
+    while len(results) < len(patterns):
+        remaining = patterns[len(results):]
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", PATTERN_TIMER_SCRIPT,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        proc.stdin.write(json.dumps({"patterns": remaining, "corpus": corpus}).encode())
+        proc.stdin.close()
+        try:
+            for _ in remaining:
+                line = await asyncio.wait_for(proc.stdout.readline(), timeout)
+                if not line:
+                    results.append({"error": "crashed the pattern timer"})
+                    break
+                results.append(json.loads(line))
+        except asyncio.TimeoutError:
+            results.append({"error": f"took longer than {timeout:g}s to match, likely catastrophic backtracking"})
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+    return results
+
+class PatternMatcher:
+    """Matches text against a list of patterns using a single combined regex.
+
+    Patterns without capturing groups are joined into one alternation of named
+    groups, so a lookup is a single scan. Patterns that can't be combined (they
+    use groups/backreferences or global inline flags) are compiled on their own
+    and checked separately. Invalid patterns are skipped.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.fallback = []
+        alternatives = []
+        for index, pattern in enumerate(self.patterns):
+            try:
+                compiled = re.compile(pattern, re.IGNORECASE)
+            except (re.error, OverflowError):
+                continue
+            try:
+                re.compile(f"(?:{pattern})", re.IGNORECASE)
+            except re.error:
+                self.fallback.append((index, compiled))
+                continue
+            if compiled.groups:
+                self.fallback.append((index, compiled))
+            else:
+                alternatives.append(f"(?P<p{index}>{pattern})")
+        self.combined = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+
+    def match(self, text):
+        """Return the first pattern (in list order) that fully matches text, or None."""
+        hit = None
+        if self.combined is not None:
+            match = self.combined.fullmatch(text)
+            if match is not None:
+                hit = int(match.lastgroup[1:])
+        for index, compiled in self.fallback:
+            if hit is not None and index > hit:
+                break
+            if compiled.fullmatch(text):
+                hit = index
+                break
+        return self.patterns[hit] if hit is not None else None
+
+class ConfigWriter:
+    """Write-behind buffer for the config document.
+
+    Changes are recorded as field-level deltas and coalesced until `flush`,
+    which sends them as `$set`, `$addToSet` and `$pull` updates. When a value
+    is added and removed before a flush, only the latest change is sent.
+    """
+    def __init__(self, db, doc_id, batch_size=100):
+        self.db = db
+        self.doc_id = doc_id
+        self.batch_size = batch_size
+        self.to_set = {}
+        self.to_add = {}
+        self.to_pull = {}
+        self.lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.to_set) + sum(map(len, self.to_add.values())) + sum(map(len, self.to_pull.values()))
+
+    @property
+    def full(self):
+        return len(self) >= self.batch_size
+
+    def set(self, field, value):
+        self.to_set[field] = value
+
+    def add(self, field, value):
+        self.to_pull.get(field, {}).pop(value, None)
+        self.to_add.setdefault(field, {})[value] = None
+
+    def pull(self, field, value):
+        self.to_add.get(field, {}).pop(value, None)
+        self.to_pull.setdefault(field, {})[value] = None
+
+    async def flush(self):
+        async with self.lock:
+            to_set, to_add, to_pull = self.to_set, self.to_add, self.to_pull
+            self.to_set, self.to_add, self.to_pull = {}, {}, {}
+
+            # mongo rejects $addToSet and $pull on the same field in one update
+            first, second = {}, {}
+            if to_set:
+                first["$set"] = to_set
+            adds = {field: {"$each": list(values)} for field, values in to_add.items() if values}
+            if adds:
+                first["$addToSet"] = adds
+            pulls = {field: {"$in": list(values)} for field, values in to_pull.items() if values}
+            if pulls:
+                second["$pull"] = pulls
+                if not any(field in adds for field in pulls):
+                    first.update(second)
+                    second = {}
+
+            try:
+                for update in (first, second):
+                    if update:
+                        await self.db.find_one_and_update({"_id": self.doc_id}, update, upsert=True)
+            except Exception:
+                self.requeue(to_set, to_add, to_pull)
+                raise
+
+    def requeue(self, to_set, to_add, to_pull):
+        """Put back deltas from a failed flush without overriding newer changes."""
+        for field, value in to_set.items():
+            self.to_set.setdefault(field, value)
+        for field, values in to_add.items():
+            for value in values:
+                if value not in self.to_pull.get(field, {}):
+                    self.to_add.setdefault(field, {})[value] = None
+        for field, values in to_pull.items():
+            for value in values:
+                if value not in self.to_add.get(field, {}):
+                    self.to_pull.setdefault(field, {})[value] = None
+
+class BanReport:
+    def __init__(self):
+        self.banned = []
+        self.missing = []
+        self.failed = {}
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        return len(self.banned) / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (
+            f"Banned {len(self.banned)}, failed {len(self.failed)}, unknown {len(self.missing)} "
+            f"in {self.elapsed:.1f}s ({self.throughput:.1f} bans/s)"
+        )
+
+class BanExecutor:
+    """Bans a batch of users with a bounded number of requests in flight.
+
+    discord.py already waits on the ban route's rate limit bucket, so the pool
+    only caps how many requests queue on it at once. Rate limits that still
+    surface and server errors are retried with exponential backoff.
+    """
+    def __init__(self, guild, concurrency=5, retries=3, backoff=1.0, reason="Alt Buster action"):
+        self.guild = guild
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.reason = reason
+
+    async def ban(self, user_id, report):
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    await self.guild.ban(discord.Object(id=user_id), reason=self.reason)
+                except discord.NotFound:
+                    report.missing.append(user_id)
+                    return
+                except discord.HTTPException as e:
+                    if (e.status == 429 or e.status >= 500) and attempt < self.retries:
+                        await asyncio.sleep(self.backoff * 2 ** attempt)
+                        continue
+                    report.failed[user_id] = e
+                    return
+                except (OSError, asyncio.TimeoutError) as e:
+                    if attempt < self.retries:
+                        await asyncio.sleep(self.backoff * 2 ** attempt)
+                        continue
+                    report.failed[user_id] = e
+                    return
+                report.banned.append(user_id)
+                return
+
+    async def run(self, user_ids):
+        report = BanReport()
+        start = time.perf_counter()
+        await asyncio.gather(*(self.ban(user_id, report) for user_id in user_ids))
+        report.elapsed = time.perf_counter() - start
+        return report
+
+LEET = str.maketrans("013457@$", "oieastas")
+# normalized names shorter than this carry too little to cluster on, e.g. names
+# written entirely in non-latin scripts, emoji or digits all normalize to ""
+MIN_NAME_LENGTH = 3
+
+def normalize_name(name):
+    """Reduce a name to lowercase ascii letters, so 'J0hn_Sm1th99' and 'john.smith' compare equal."""
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().lower()
+    # numbered suffixes are the usual way raid accounts differ, drop them before undoing leetspeak
+    name = re.sub(r"[\W\d_]+$", "", name).translate(LEET)
+    return "".join(c for c in name if c.isalpha())[:32]
+
+def within_distance(a, b, limit):
+    """Whether the edit distance between a and b is at most limit."""
+    if abs(len(a) - len(b)) > limit:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return False
+        previous = current
+    return previous[-1] <= limit
+
+class JoinRateDetector:
+    """Flags bursts of joins from new accounts with similar names.
+
+    Joins are kept in a fixed-size ring buffer that only covers the last
+    `window` seconds, along with a count of each normalized name in it. Both
+    are updated as joins are added and expire, so a join costs amortized O(1)
+    and memory is bounded by the buffer size. Only when the window holds a
+    burst are the names compared by edit distance, which is bounded by the
+    buffer size as well.
+    """
+    def __init__(self, size=128):
+        self.ring = [None] * size
+        self.start = 0
+        self.length = 0
+        self.names = {}
+
+    def expire(self, now, window):
+        while self.length:
+            joined_at, name, _ = self.ring[self.start]
+            if now - joined_at <= window:
+                break
+            self.evict()
+
+    def evict(self):
+        _, name, _ = self.ring[self.start]
+        if name is not None:
+            self.names[name] -= 1
+            if not self.names[name]:
+                del self.names[name]
+        self.ring[self.start] = None
+        self.start = (self.start + 1) % len(self.ring)
+        self.length -= 1
+
+    def add(self, member, settings, now):
+        """Record a join and return the IDs of the members in its cluster if it's part of a raid."""
+        self.expire(now, settings["window"])
+        if self.length == len(self.ring):
+            self.evict()
+
+        # established accounts, and names too short to compare, count towards the join rate but are never clustered
+        age = (now - member.created_at.timestamp()) / 86400
+        name = normalize_name(member.name) if age <= settings["max_account_age"] else None
+        if name is not None and len(name) < MIN_NAME_LENGTH:
+            name = None
+        self.ring[(self.start + self.length) % len(self.ring)] = (now, name, member.id)
+        self.length += 1
+        if name is None:
+            return []
+        self.names[name] = self.names.get(name, 0) + 1
+
+        if self.length < settings["min_joins"]:
+            return []
+        similar = {name}
+        if self.names[name] < settings["min_joins"] and len(name) >= 5:
+            similar.update(other for other in self.names if within_distance(name, other, 2))
+        if sum(self.names[other] for other in similar) < settings["min_joins"]:
+            return []
+        return [
+            member_id for _, other, member_id in
+            (self.ring[(self.start + i) % len(self.ring)] for i in range(self.length))
+            if other in similar
+        ]
+
+class GuildConfig:
+    """Alt buster config and runtime state for a single guild."""
+    def __init__(self, db, guild_id):
+        self.db = db
+        self.guild_id = guild_id
+        self.doc_id = f"altbuster-{guild_id}"
+        self.config = None
+        self.pending_users = set()
+        self.writer = ConfigWriter(db, self.doc_id)
+        self.sweep_lock = asyncio.Lock()
+        self.recent_names = deque(maxlen=100)
+        self.recent_messages = deque(maxlen=100)
+        self.join_detector = JoinRateDetector()
+
+    async def load(self, default_config, legacy=False):
+        self.config = await self.db.find_one({"_id": self.doc_id})
+        if not self.config and legacy:
+            # configs from before multi-guild support were stored under a single id
+            self.config = await self.db.find_one({"_id": "altbuster"})
+            if self.config:
+                self.config.pop("_id")
+                for user_id in self.config.get("pending_users", []):
+                    self.writer.add("pending_users", user_id)
+        if not self.config:
+            self.config = {}
+        for key, value in default_config.items():
+            if key not in self.config:
+                self.config[key] = deepcopy(value)
+        # pending users are kept as a set in memory and persisted with
+        # $addToSet/$pull, so they are never part of the $set in update_config
+        self.pending_users = set(self.config.pop("pending_users", []))
+        await self.update_config()
+        await self.writer.flush()
+        self.rebuild_matchers()
+
+    def rebuild_matchers(self):
+        self.username_matcher = PatternMatcher(self.config["usernames"])
+        self.message_matcher = PatternMatcher(self.config["messages"])
+
+    async def update_config(self):
+        await self.db.find_one_and_update(
+            {"_id": self.doc_id},
+            {"$set": self.config},
+            upsert=True,
+        )
+
+    async def add_pending(self, user_id):
+        self.pending_users.add(user_id)
+        self.writer.add("pending_users", user_id)
+        if self.writer.full:
+            await self.writer.flush()
+
+    async def remove_pending(self, *user_ids):
+        self.pending_users.difference_update(user_ids)
+        for user_id in user_ids:
+            self.writer.pull("pending_users", user_id)
+        if self.writer.full:
+            await self.writer.flush()
+
+    def corpus(self):
+        return SAMPLE_CORPUS + list(self.recent_names) + list(self.recent_messages)
+
 class AltBuster(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -13,145 +443,447 @@ class AltBuster(commands.Cog):
             "enabled": False,
             "usernames": [],
             "messages": [],
-            "pending_users": []
+            "pending_users": [],
+            "raid_detection": {
+                "enabled": False,
+                "window": 60,
+                "min_joins": 5,
+                "max_account_age": 7,
+            },
         }
-        # self.process_pending_users.start()
+        self.guild_configs = {}
+        self.loading = {}
+        self.max_match_time = 0.01
 
     async def cog_load(self):
-        self.config = await self.db.find_one({"_id": "altbuster"})
-        if not self.config:
-            self.config = self.default_config
-            await self.update_config()
+        self.flush_config.start()
+        self.process_pending_users.start()
 
-    async def update_config(self):
-        await self.db.find_one_and_update(
-            {"_id": "altbuster"},
-            {"$set": self.config},
-            upsert=True,
-        )
+    async def cog_unload(self):
+        self.flush_config.cancel()
+        self.process_pending_users.cancel()
+        for state in self.guild_configs.values():
+            await state.writer.flush()
+
+    @tasks.loop(seconds=5)
+    async def flush_config(self):
+        for state in list(self.guild_configs.values()):
+            try:
+                await state.writer.flush()
+            except Exception as e:
+                print(f"Failed to save alt buster config for guild {state.guild_id}: {e}")
+
+    def resolve_guild(self, guild):
+        """Map DMs and the modmail staff server to the main guild."""
+        if guild is None or (guild == self.bot.modmail_guild and guild != self.bot.guild):
+            return self.bot.guild
+        return guild
+
+    async def get_config(self, guild):
+        """Return the config for a guild, loading it on first use."""
+        guild = self.resolve_guild(guild)
+        state = self.guild_configs.get(guild.id)
+        if state is not None:
+            return state
+        if guild.id not in self.loading:
+            self.loading[guild.id] = asyncio.ensure_future(self.load_config(guild.id))
+        return await asyncio.shield(self.loading[guild.id])
+
+    async def load_config(self, guild_id):
+        try:
+            state = GuildConfig(self.db, guild_id)
+            await state.load(self.default_config, legacy=guild_id == self.bot.guild_id)
+            self.guild_configs[guild_id] = state
+            return state
+        finally:
+            del self.loading[guild_id]
+
+    async def validate_patterns(self, state, patterns):
+        """Return a dict of pattern to the reason it was rejected, or None if it's accepted."""
+        results = await time_patterns(patterns, state.corpus())
+        errors = {}
+        for pattern, result in zip(patterns, results):
+            if result["error"] is None and result["worst"] > self.max_match_time:
+                result["error"] = f"too slow, worst match took {result['worst'] * 1000:.1f}ms"
+            errors[pattern] = result["error"]
+        return errors
+
+    async def send_list(self, ctx, title, items, filename):
+        """Send a list as a message, or as a text file if it doesn't fit in one."""
+        text = title + "\n" + "\n".join(items)
+        if len(text) <= 2000:
+            await ctx.send(text)
+        else:
+            data = BytesIO("\n".join(items).encode("utf-8"))
+            await ctx.send(f"{title} ({len(items)} entries)", file=discord.File(data, filename=filename))
+
+    async def read_patterns(self, attachment, kind):
+        """Read patterns from an attached file, grouped by list name.
+
+        Text files are streamed one pattern per line into the `kind` list. JSON
+        files can hold a list of patterns for `kind`, or an object with
+        "usernames" and/or "messages" lists. The json module can't parse
+        incrementally, so JSON files are read whole and limited in size instead.
+        """
+        if attachment.filename.lower().endswith(".json"):
+            if attachment.size > MAX_JSON_IMPORT_SIZE:
+                raise ValueError(f"JSON files can be at most {MAX_JSON_IMPORT_SIZE // (1024 * 1024)} MB, use a text file for larger lists")
+            data = json.loads(await attachment.read())
+            if isinstance(data, list):
+                data = {kind: data}
+            if not isinstance(data, dict):
+                raise ValueError("the JSON file must contain a list or an object")
+        else:
+            data = {kind: []}
+            async with self.bot.session.get(attachment.url) as resp:
+                resp.raise_for_status()
+                async for line in resp.content:
+                    line = line.decode("utf-8").strip()
+                    if line:
+                        data[kind].append(line)
+
+        patterns = {}
+        for key, values in data.items():
+            if key is None:
+                raise ValueError("specify whether the list holds usernames or messages")
+            if key not in ("usernames", "messages"):
+                raise ValueError(f"unknown list '{key}', expected usernames or messages")
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                raise ValueError(f"'{key}' must be a list of strings")
+            patterns[key] = values
+        return patterns
 
     @commands.group(name="altbuster", invoke_without_command=True)
     @checks.has_permissions(PermissionLevel.ADMIN)
     async def altbuster(self, ctx):
-        """Manage the alt buster settings."""
+        """Manage the alt buster settings.
+
+        Settings apply to the server the command is used in. Commands used in
+        the modmail server or in DMs apply to the main server.
+        """
         await ctx.send_help(ctx.command)
 
     @altbuster.command(name="toggle", help="Enable or disable the alt buster")
     @checks.has_permissions(PermissionLevel.ADMIN)
     async def altbuster_toggle(self, ctx):
-        self.config["enabled"] = not self.config["enabled"]
-        await self.update_config()
-        status = "enabled" if self.config["enabled"] else "disabled"
+        state = await self.get_config(ctx.guild)
+        state.config["enabled"] = not state.config["enabled"]
+        state.writer.set("enabled", state.config["enabled"])
+        await state.writer.flush()
+        status = "enabled" if state.config["enabled"] else "disabled"
         await ctx.send(f"Alt Buster has been {status}.")
 
     @altbuster.command(name="addusername", help="Add a username to the alt list")
     @checks.has_permissions(PermissionLevel.ADMIN)
     async def altbuster_addusername(self, ctx, *, username: str):
-        if username in self.config["usernames"]:
+        state = await self.get_config(ctx.guild)
+        if username in state.config["usernames"]:
             await ctx.send("This username is already in the alt list.")
             return
-        self.config["usernames"].append(username)
-        await self.update_config()
+        error = (await self.validate_patterns(state, [username]))[username]
+        if error:
+            await ctx.send(f"This pattern was rejected: {error}")
+            return
+        state.config["usernames"].append(username)
+        state.rebuild_matchers()
+        state.writer.add("usernames", username)
+        await state.writer.flush()
         await ctx.send(f"Added '{username}' to the alt list.")
 
     @altbuster.command(name="removeusername", help="Remove a username from the alt list")
     @checks.has_permissions(PermissionLevel.ADMIN)
     async def altbuster_removeusername(self, ctx, *, username: str):
-        if username not in self.config["usernames"]:
+        state = await self.get_config(ctx.guild)
+        if username not in state.config["usernames"]:
             await ctx.send("This username is not in the alt list.")
             return
-        self.config["usernames"].remove(username)
-        await self.update_config()
+        state.config["usernames"].remove(username)
+        state.rebuild_matchers()
+        state.writer.pull("usernames", username)
+        await state.writer.flush()
         await ctx.send(f"Removed '{username}' from the alt list.")
 
     @altbuster.command(name="addmessage", help="Add a message for the alt buster")
     @checks.has_permissions(PermissionLevel.ADMIN)
     async def altbuster_addmessage(self, ctx, *, message: str):
-        self.config["messages"].append(message)
-        await self.update_config()
+        state = await self.get_config(ctx.guild)
+        if message in state.config["messages"]:
+            await ctx.send("This message is already in the alt buster list.")
+            return
+        error = (await self.validate_patterns(state, [message]))[message]
+        if error:
+            await ctx.send(f"This pattern was rejected: {error}")
+            return
+        state.config["messages"].append(message)
+        state.rebuild_matchers()
+        state.writer.add("messages", message)
+        await state.writer.flush()
         await ctx.send("Added a new message for the alt buster.")
 
     @altbuster.command(name="removemessage", help="Remove a message from the alt buster")
     @checks.has_permissions(PermissionLevel.ADMIN)
     async def altbuster_removemessage(self, ctx, *, message: str):
-        if message not in self.config["messages"]:
+        state = await self.get_config(ctx.guild)
+        if message not in state.config["messages"]:
             await ctx.send("This message is not in the alt buster list.")
             return
-        self.config["messages"].remove(message)
-        await self.update_config()
+        state.config["messages"].remove(message)
+        state.rebuild_matchers()
+        state.writer.pull("messages", message)
+        await state.writer.flush()
         await ctx.send("Removed the message from the alt buster list.")
 
+    @altbuster.command(name="benchmark", help="Show the patterns that are the most expensive to match")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def altbuster_benchmark(self, ctx):
+        state = await self.get_config(ctx.guild)
+        patterns = state.config["usernames"] + state.config["messages"]
+        if not patterns:
+            await ctx.send("There are no patterns to benchmark.")
+            return
+        corpus = state.corpus()
+        async with ctx.typing():
+            results = await time_patterns(patterns, corpus)
+        rows = sorted(zip(patterns, results), key=lambda row: row[1].get("mean", float("inf")), reverse=True)
+        lines = []
+        for pattern, result in rows[:15]:
+            if result["error"]:
+                lines.append(f"{'error':>10}  {pattern[:60]} ({result['error']})")
+            else:
+                lines.append(f"{result['mean'] * 1e6:8.1f}µs  {pattern[:60]}")
+        total = sum(result.get("mean", 0) for result in results)
+        await ctx.send(
+            f"Mean cost per match over {len(corpus)} sample inputs, most expensive first "
+            f"(total {total * 1e6:.1f}µs for all {len(patterns)} patterns):\n```\n" + "\n".join(lines)[:1800] + "\n```"
+        )
+
+    @altbuster.group(name="raid", invoke_without_command=True)
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def altbuster_raid(self, ctx):
+        """Show the raid detection settings.
+
+        Raid detection flags new accounts with similar names that join in a
+        burst: at least `min_joins` joins within `window` seconds from accounts
+        younger than `max_account_age` days.
+        """
+        state = await self.get_config(ctx.guild)
+        settings = state.config["raid_detection"]
+        await ctx.send(
+            f"Raid detection is {'enabled' if settings['enabled'] else 'disabled'}.\n"
+            f"window: {settings['window']} seconds\n"
+            f"min_joins: {settings['min_joins']}\n"
+            f"max_account_age: {settings['max_account_age']} days"
+        )
+
+    @altbuster_raid.command(name="toggle", help="Enable or disable raid detection")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def altbuster_raid_toggle(self, ctx):
+        state = await self.get_config(ctx.guild)
+        settings = state.config["raid_detection"]
+        settings["enabled"] = not settings["enabled"]
+        state.writer.set("raid_detection.enabled", settings["enabled"])
+        await state.writer.flush()
+        await ctx.send(f"Raid detection has been {'enabled' if settings['enabled'] else 'disabled'}.")
+
+    @altbuster_raid.command(name="set", help="Set window, min_joins or max_account_age for raid detection")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def altbuster_raid_set(self, ctx, setting: str, value: int):
+        if setting not in ("window", "min_joins", "max_account_age"):
+            await ctx.send("The setting must be one of `window`, `min_joins` or `max_account_age`.")
+            return
+        if value < 1 or (setting == "min_joins" and value < 2):
+            await ctx.send("That value is too low.")
+            return
+        state = await self.get_config(ctx.guild)
+        state.config["raid_detection"][setting] = value
+        state.writer.set(f"raid_detection.{setting}", value)
+        await state.writer.flush()
+        await ctx.send(f"Set {setting} to {value}.")
+
+    @altbuster.command(name="import", help="Import usernames or messages from an attached text or JSON file")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def altbuster_import(self, ctx, kind: str = None):
+        """Import patterns from an attached file.
+
+        A text file holds one pattern per line and needs `kind` (usernames or
+        messages). A JSON file can hold a list of patterns for `kind`, or an
+        object with "usernames" and/or "messages" lists, like `altbuster export`
+        produces. Duplicates and rejected patterns are skipped.
+        """
+        if not ctx.message.attachments:
+            await ctx.send("You must attach a text or JSON file to import from.")
+            return
+        if kind is not None and kind not in ("usernames", "messages"):
+            await ctx.send("The list to import into must be `usernames` or `messages`.")
+            return
+        attachment = ctx.message.attachments[0]
+        if kind is None and not attachment.filename.lower().endswith(".json"):
+            await ctx.send("You must specify whether to import `usernames` or `messages`.")
+            return
+        state = await self.get_config(ctx.guild)
+
+        try:
+            imported = await self.read_patterns(attachment, kind)
+        except (ValueError, UnicodeDecodeError) as e:
+            await ctx.send(f"Could not read the file: {e}")
+            return
+        except (aiohttp.ClientError, discord.HTTPException) as e:
+            await ctx.send(f"Could not download the file: {e}")
+            return
+
+        summary = []
+        async with ctx.typing():
+            for key, values in imported.items():
+                existing = set(state.config[key])
+                new = [value for value in dict.fromkeys(values) if value not in existing]
+                errors = await self.validate_patterns(state, new) if new else {}
+                accepted = [value for value in new if errors[value] is None]
+                state.config[key].extend(accepted)
+                for value in accepted:
+                    state.writer.add(key, value)
+                summary.append(
+                    f"{key}: added {len(accepted)}, skipped {len(values) - len(new)} duplicates, rejected {len(new) - len(accepted)}"
+                )
+                rejected = [f"{value}: {errors[value]}" for value in new if errors[value] is not None]
+                if rejected:
+                    summary.extend(f"  {line}" for line in rejected[:10])
+                    if len(rejected) > 10:
+                        summary.append(f"  ...and {len(rejected) - 10} more")
+            state.rebuild_matchers()
+            await state.writer.flush()
+        await ctx.send("Import finished.\n```\n" + "\n".join(summary)[:1900] + "\n```")
+
+    @altbuster.command(name="export", help="Export the usernames and messages lists as a JSON file")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def altbuster_export(self, ctx):
+        state = await self.get_config(ctx.guild)
+        data = BytesIO(json.dumps({
+            "usernames": state.config["usernames"],
+            "messages": state.config["messages"],
+        }, indent=4).encode("utf-8"))
+        await ctx.send(file=discord.File(data, filename="altbuster.json"))
+
     @altbuster.command(name="listusernames", help="List all usernames in the alt list")
     @checks.has_permissions(PermissionLevel.ADMIN)
     async def altbuster_listusernames(self, ctx):
-        if not self.config["usernames"]:
+        state = await self.get_config(ctx.guild)
+        if not state.config["usernames"]:
             await ctx.send("The alt list is empty.")
             return
-        await ctx.send("Alt list usernames:\n" + "\n".join(self.config["usernames"]))
+        await self.send_list(ctx, "Alt list usernames:", state.config["usernames"], "usernames.txt")
 
     @altbuster.command(name="listmessages", help="List all messages in the alt buster")
     @checks.has_permissions(PermissionLevel.ADMIN)
     async def altbuster_listmessages(self, ctx):
-        if not self.config["messages"]:
+        state = await self.get_config(ctx.guild)
+        if not state.config["messages"]:
             await ctx.send("The alt buster messages list is empty.")
             return
-        await ctx.send("Alt buster messages:\n" + "\n".join(self.config["messages"]))
+        await self.send_list(ctx, "Alt buster messages:", state.config["messages"], "messages.txt")
 
     @altbuster.command(name="listpending", help="List all pending users to be banned")
     @checks.has_permissions(PermissionLevel.ADMIN)
     async def altbuster_listpending(self, ctx):
-        if not self.config["pending_users"]:
+        state = await self.get_config(ctx.guild)
+        if not state.pending_users:
             await ctx.send("There are no pending users to be banned.")
             return
-        await ctx.send("Pending users to be banned:\n" + "\n".join(map(str, self.config["pending_users"])))
+        await self.send_list(ctx, "Pending users to be banned:", list(map(str, sorted(state.pending_users))), "pending.txt")
 
     @altbuster.command(name="removepending", help="Remove a user from the pending ban list")
     @checks.has_permissions(PermissionLevel.ADMIN)
     async def altbuster_removepending(self, ctx, user_id: int):
-        if user_id not in self.config["pending_users"]:
+        state = await self.get_config(ctx.guild)
+        if user_id not in state.pending_users:
             await ctx.send("This user is not in the pending ban list.")
             return
-        self.config["pending_users"].remove(user_id)
-        await self.update_config()
+        await state.remove_pending(user_id)
         await ctx.send(f"Removed user {user_id} from the pending ban list.")
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
-        if not self.config["enabled"] or member.bot:
+        if member.bot:
+            return
+        state = await self.get_config(member.guild)
+        if not state.config["enabled"]:
             return
+        state.recent_names.append(member.name)
 
-        if member.id in self.config["pending_users"]:
+        if state.config["raid_detection"]["enabled"]:
+            raid = state.join_detector.add(member, state.config["raid_detection"], time.time())
+            for user_id in raid:
+                if user_id not in state.pending_users:
+                    await state.add_pending(user_id)
+
+        if member.id in state.pending_users:
             return
 
-        for username in self.config["usernames"]:
-            if re.fullmatch(username, member.name, re.IGNORECASE):
-                self.config["pending_users"].append(member.id)
-                await self.update_config()
+        if state.username_matcher.match(member.name) is not None:
+            await state.add_pending(member.id)
 
     @commands.Cog.listener()
     async def on_message(self, message):
-        if message.author.bot or not self.config["enabled"]:
+        if message.author.bot:
+            return
+        state = await self.get_config(message.guild)
+        if not state.config["enabled"]:
             return
+        state.recent_messages.append(message.content)
 
-        if message.author.id in self.config["pending_users"]:
+        if message.author.id in state.pending_users:
             return
 
-        for msg in self.config["messages"]:
-            if re.fullmatch(msg, message.content, re.IGNORECASE):
-                self.config["pending_users"].append(message.author.id)
-                await self.update_config()
-                return
+        if state.message_matcher.match(message.content) is not None:
+            await state.add_pending(message.author.id)
+
+    async def sweep(self, guild):
+        """Ban all pending users of a guild. Users that couldn't be banned stay pending."""
+        state = await self.get_config(guild)
+        async with state.sweep_lock:
+            # snapshot so users flagged while the sweep runs are kept for the next one
+            report = await BanExecutor(guild).run(list(state.pending_users))
+            for user_id, e in report.failed.items():
+                print(f"Failed to ban user {user_id} in guild {guild.id}: {e}")
+            done = report.banned + report.missing
+            if done:
+                await state.remove_pending(*done)
+                await state.writer.flush()
+            print(f"Alt Buster sweep for guild {guild.id}: {report}")
+            return report
+
+    @altbuster.command(name="sweep", help="Ban all pending users now")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def altbuster_sweep(self, ctx):
+        guild = self.resolve_guild(ctx.guild)
+        state = await self.get_config(guild)
+        if not state.pending_users:
+            await ctx.send("There are no pending users to be banned.")
+            return
+        await ctx.send(f"Banning {len(state.pending_users)} pending users...")
+        report = await self.sweep(guild)
+        await ctx.send(f"Sweep finished. {report}.")
 
     @tasks.loop(hours=24)
     async def process_pending_users(self):
-        guild: discord.Guild = self.bot.guilds[0]  # Assuming the bot is only in one guild
-        for user_id in self.config["pending_users"]:
-            try:
-                await guild.ban(discord.Object(id=user_id), reason="Alt Buster action")
-            except Exception as e:
-                print(f"Failed to ban user {user_id}: {e}")
-        self.config["pending_users"].clear()
-        await self.update_config()
+        # the first pass runs at startup, don't ban everyone pending on every restart
+        if self.process_pending_users.current_loop == 0:
+            return
+        # only guilds that have used alt buster since startup and still have it enabled,
+        # so this neither creates config documents nor bans after alt buster was turned off
+        guilds = [
+            guild for guild in (self.bot.get_guild(state.guild_id) for state in list(self.guild_configs.values())
+                                if state.config["enabled"] and state.pending_users)
+            if guild is not None
+        ]
+        # each guild sweeps independently, so a large backlog in one doesn't hold up the others
+        results = await asyncio.gather(*(self.sweep(guild) for guild in guilds), return_exceptions=True)
+        for guild, result in zip(guilds, results):
+            if isinstance(result, Exception):
+                print(f"Alt Buster sweep for guild {guild.id} failed: {result}")
+
+    @process_pending_users.before_loop
+    async def before_process_pending_users(self):
+        await self.bot.wait_until_ready()
 
 async def setup(bot):
     await bot.add_cog(AltBuster(bot))
\ No newline at end of file
@@ -1,3 +1,6 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 import discord
 from discord.ext import commands
 
@@ -5,30 +8,318 @@ from core import checks
 from core.models import PermissionLevel
 
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps
+
+# Images are processed by at most MAX_WORKERS threads, with up to MAX_QUEUED more waiting.
+# Anything beyond that is turned away instead of piling up. Together they fit a message's 10 attachments.
+MAX_WORKERS = 2
+MAX_QUEUED = 8
+# discord allows at most this many files per message
+FILES_PER_MESSAGE = 10
+
+
+MAX_SIZE = 4096
+# discord's smallest upload limit, used when the guild's can't be looked up
+DEFAULT_UPLOAD_LIMIT = 8 * 1024 * 1024
+# the lowest quality and smallest scale tried when shrinking an image to fit
+MIN_QUALITY = 40
+MIN_SCALE = 0.25
+
+# libjpeg's quality 50 luminance table, other qualities are scaled from it
+STANDARD_LUMINANCE_TOTAL = sum((
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99,
+))
+
+
+def parse_size(value: str):
+    width, _, height = value.lower().partition("x")
+    try:
+        size = int(width), int(height)
+    except ValueError:
+        raise commands.BadArgument(f"`{value}` isn't a size, use WIDTHxHEIGHT like `512x512`.")
+    if not all(0 < n <= MAX_SIZE for n in size):
+        raise commands.BadArgument(f"Sizes must be between 1 and {MAX_SIZE} pixels.")
+    return size
+
+
+def parse_box(value: str):
+    try:
+        box = tuple(int(n) for n in value.split(","))
+    except ValueError:
+        box = ()
+    if len(box) != 4 or box[0] >= box[2] or box[1] >= box[3] or min(box) < 0:
+        raise commands.BadArgument(f"`{value}` isn't a crop box, use LEFT,TOP,RIGHT,BOTTOM like `0,0,100,100`.")
+    return box
+
+
+def parse_bytes(value: str):
+    units = {"kb": 1024, "mb": 1024 * 1024, "b": 1}
+    number, multiplier = value.lower(), 1
+    for unit, size in units.items():
+        if number.endswith(unit):
+            number, multiplier = number[:-len(unit)], size
+            break
+    try:
+        # int() raises OverflowError for inf, and ValueError for nan
+        size = int(float(number) * multiplier)
+    except (ValueError, OverflowError):
+        raise commands.BadArgument(f"`{value}` isn't a file size, use something like `2mb` or `500kb`.")
+    if size < 16 * 1024:
+        raise commands.BadArgument("The maximum file size must be at least 16kb.")
+    return size
+
+
+def parse_angle(value: str):
+    try:
+        return float(value)
+    except ValueError:
+        raise commands.BadArgument(f"`{value}` isn't an angle in degrees.")
+
+
+def crop(image: Image.Image, box) -> Image.Image:
+    left, top, right, bottom = box
+    if left >= image.width or top >= image.height:
+        raise commands.BadArgument(f"The crop box {left},{top},{right},{bottom} is outside the {image.width}x{image.height} image.")
+    return image.crop((left, top, min(right, image.width), min(bottom, image.height)))
+
+
+def rotate(image: Image.Image, angle: float) -> Image.Image:
+    if angle % 90 == 0:
+        # lossless and keeps the exact pixels
+        return image.rotate(angle, expand=True)
+    return image.rotate(angle, expand=True, resample=Image.Resampling.BICUBIC)
+
+
+# name: (argument parser or None, transform)
+OPERATIONS = {
+    "flip-h": (None, lambda image: image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)),
+    "flip-v": (None, lambda image: image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)),
+    "rotate": (parse_angle, rotate),
+    "resize": (parse_size, lambda image, size: image.resize(size, Image.Resampling.LANCZOS)),
+    "crop": (parse_box, crop),
+    "grayscale": (None, ImageOps.grayscale),
+}
+
+
+def parse_operations(args):
+    """
+    Turn `flip-h rotate 90 resize 512x512 max-size 2mb` into a list of (transform, arguments)
+    and the requested maximum file size, if any.
+    """
+    operations = []
+    max_bytes = None
+    args = iter(args)
+    for name in args:
+        if name.lower() == "max-size":
+            value = next(args, None)
+            if value is None:
+                raise commands.BadArgument(f"`{name}` needs a value.")
+            max_bytes = parse_bytes(value)
+            continue
+        try:
+            parser, transform = OPERATIONS[name.lower()]
+        except KeyError:
+            raise commands.BadArgument(f"`{name}` isn't an operation, use one of: {', '.join(OPERATIONS)}.")
+        if parser is None:
+            operations.append((transform, ()))
+            continue
+        value = next(args, None)
+        if value is None:
+            raise commands.BadArgument(f"`{name}` needs a value.")
+        operations.append((transform, (parser(value),)))
+    return operations, max_bytes
+
+
+def estimate_jpeg_quality(image: Image.Image) -> int:
+    """Estimate the quality a JPEG was saved with from its luminance quantization table."""
+    tables = getattr(image, "quantization", None)
+    if not tables or 0 not in tables:
+        return 85
+    scale = sum(tables[0]) * 100 / STANDARD_LUMINANCE_TOTAL
+    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+    return max(1, min(95, round(quality)))
+
+
+def encode(image: Image.Image, fmt: str, quality: int) -> BytesIO:
+    to_send_bytes: BytesIO = BytesIO()
+    # keep the colour profile so wide gamut photos don't come back with shifted colours,
+    # unless the image was turned grayscale and a colour profile no longer applies
+    icc_profile = image.info.get("icc_profile") if image.mode not in ("L", "LA") else None
+    if fmt == "JPEG":
+        if image.mode not in ("RGB", "L", "CMYK"):
+            image = image.convert("RGB")
+        image.save(to_send_bytes, format="JPEG", quality=quality, optimize=True, icc_profile=icc_profile)
+    elif fmt == "WEBP":
+        image.save(to_send_bytes, format="WEBP", quality=quality, method=4, icc_profile=icc_profile)
+    else:
+        image.save(to_send_bytes, format="PNG", optimize=True, icc_profile=icc_profile)
+    to_send_bytes.seek(0)
+    return to_send_bytes
+
+
+def encode_within(image: Image.Image, fmt: str, quality: int, max_bytes: int) -> BytesIO:
+    """
+    Encode an image in `fmt`, lowering the quality of lossy formats and then
+    scaling the image down until it fits in `max_bytes`.
+    """
+    to_send_bytes = encode(image, fmt, quality)
+    size = to_send_bytes.getbuffer().nbytes
+    if fmt != "PNG":
+        while size > max_bytes and quality > MIN_QUALITY:
+            quality = max(MIN_QUALITY, quality - 15)
+            to_send_bytes = encode(image, fmt, quality)
+            size = to_send_bytes.getbuffer().nbytes
+    scale = 1.0
+    resized = image
+    while size > max_bytes:
+        # the file size roughly follows the pixel count, aim a bit under the limit
+        scale *= min(0.9, (max_bytes / size) ** 0.5 * 0.95)
+        if scale < MIN_SCALE:
+            raise ValueError(f"Couldn't make the image smaller than {max_bytes // 1024}kb.")
+        resized = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.Resampling.LANCZOS)
+        to_send_bytes = encode(resized, fmt, quality)
+        size = to_send_bytes.getbuffer().nbytes
+    return to_send_bytes
+
+
+def transform_image(data: bytes, operations, max_bytes: int):
+    """
+    Decode an image once, apply every operation and encode it once. Runs in the worker pool, never on the event loop.
+
+    The image is turned upright from its EXIF orientation first and EXIF is left out of the output.
+    JPEG and WebP images stay in their format at about the same quality, everything else becomes a lossless PNG.
+    Returns the encoded image and its file extension.
+    """
+    image: Image.Image = Image.open(BytesIO(data))
+    fmt = image.format if image.format in ("JPEG", "WEBP") else "PNG"
+    quality = estimate_jpeg_quality(image) if fmt == "JPEG" else 80
+    image = ImageOps.exif_transpose(image)
+    image.info.pop("exif", None)
+    for transform, args in operations:
+        image = transform(image, *args)
+    extension = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png"}[fmt]
+    return encode_within(image, fmt, quality, max_bytes), extension
+
 
 class ImgFlipper(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="imgflipper")
+        self.pending = 0
+
+    async def cog_unload(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def busy(self, count):
+        return self.pending + count > MAX_WORKERS + MAX_QUEUED
+
+    async def run(self, func, *args):
+        """Run `func` in the worker pool."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def transform(self, attachment: discord.Attachment, operations, max_bytes: int):
+        try:
+            data = await attachment.read()
+        except discord.HTTPException:
+            raise ValueError(f"I couldn't download `{attachment.filename}`.")
+        try:
+            return await self.run(transform_image, data, operations, max_bytes)
+        except (Image.UnidentifiedImageError, Image.DecompressionBombError):
+            raise ValueError(f"I couldn't read `{attachment.filename}`.")
+        except (commands.BadArgument, ValueError) as e:
+            raise ValueError(f"`{attachment.filename}`: {e}")
+        except OSError as e:
+            # Pillow raises plain OSError for truncated files and modes a format can't store
+            raise ValueError(f"I couldn't process `{attachment.filename}`: {e}")
 
     @checks.has_permissions(PermissionLevel.SUPPORTER)
     @commands.command()
     async def imgflip(self, ctx: commands.Context):
-        """Flip an image horizontally"""
-        if not ctx.message.attachments:
-            await ctx.send("You need to attach an image!")
+        """Flip images horizontally"""
+        await self.process(ctx, ["flip-h"], "flipped")
+
+    @checks.has_permissions(PermissionLevel.SUPPORTER)
+    @commands.command()
+    async def imgedit(self, ctx: commands.Context, *operations: str):
+        """
+        Apply several edits to images in one go
+
+        Every image attached to the message is edited.
+
+        The operations are applied in the order given:
+        - `flip-h`, `flip-v`: flip horizontally or vertically
+        - `rotate <degrees>`: rotate counter clockwise
+        - `resize <width>x<height>`
+        - `crop <left>,<top>,<right>,<bottom>`
+        - `grayscale`
+
+        Add `max-size <size>` (e.g. `2mb`) to shrink the result until it fits.
+        JPEG and WebP images keep their format, anything else is sent back as PNG.
+
+        Example: `{prefix}imgedit crop 0,0,800,600 rotate 90 grayscale`
+        """
+        if not operations:
+            return await ctx.send_help(ctx.command)
+        await self.process(ctx, operations, "edited")
+
+    async def process(self, ctx: commands.Context, args, name: str):
+        try:
+            operations, max_bytes = parse_operations(args)
+        except commands.BadArgument as e:
+            await ctx.send(str(e))
             return
-        attachment: discord.Attachment = ctx.message.attachments[0]
-        if not attachment.content_type.startswith("image/"):
+        attachments = [
+            attachment for attachment in ctx.message.attachments
+            if attachment.content_type and attachment.content_type.startswith("image/")
+        ]
+        if not attachments:
             await ctx.send("You need to attach an image!")
             return
-        image_bytes: BytesIO = BytesIO(await attachment.read())
-        image: Image.Image = Image.open(image_bytes)
-        flipped_image: Image.Image = image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
-        to_send_bytes: BytesIO = BytesIO()
-        flipped_image.save(to_send_bytes, format="PNG")
-        to_send_bytes.seek(0)
-        await ctx.send(file=discord.File(to_send_bytes, filename="flipped.png"))
+        if self.busy(len(attachments)):
+            await ctx.send("I'm busy with other images, try again in a bit.")
+            return
+        upload_limit = ctx.guild.filesize_limit if ctx.guild else DEFAULT_UPLOAD_LIMIT
+        max_bytes = min(max_bytes, upload_limit) if max_bytes else upload_limit
+
+        # hold the slots from the downloads on, so other commands see the pool filling up
+        self.pending += len(attachments)
+        try:
+            results = await asyncio.gather(
+                *(self.transform(attachment, operations, max_bytes) for attachment in attachments),
+                return_exceptions=True,
+            )
+        finally:
+            self.pending -= len(attachments)
+
+        files = []
+        errors = []
+        for attachment, result in zip(attachments, results):
+            if isinstance(result, ValueError):
+                errors.append(str(result))
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                to_send_bytes, extension = result
+                stem = attachment.filename.rsplit(".", 1)[0]
+                files.append((to_send_bytes, f"{stem}-{name}.{extension}"))
+
+        # as few messages as possible, within the file count and upload limits
+        batch = []
+        batch_size = 0
+        for to_send_bytes, filename in files:
+            size = to_send_bytes.getbuffer().nbytes
+            if batch and (len(batch) == FILES_PER_MESSAGE or batch_size + size > upload_limit):
+                await ctx.send(files=batch)
+                batch, batch_size = [], 0
+            batch.append(discord.File(to_send_bytes, filename=filename))
+            batch_size += size
+        if batch:
+            await ctx.send(files=batch)
+        if errors:
+            await ctx.send("\n".join(errors))
 
 async def setup(bot):
-    await bot.add_cog(ImgFlipper(bot))
\ No newline at end of file
+    await bot.add_cog(ImgFlipper(bot))
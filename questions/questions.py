@@ -1,20 +1,228 @@
 import asyncio
 import copy
 from datetime import datetime
+import heapq
+from io import BytesIO
+import time
+import traceback
 
 import discord
 from discord.channel import CategoryChannel
-from discord.ext import commands
+from discord.ext import commands, tasks
+
+from pymongo import ReturnDocument
 
 from core import checks
 from core.models import DummyMessage, PermissionLevel
 
 
+# how long a recipient has to answer each question, in seconds
+QUESTION_TIMEOUT = 15000
+
+
+class ExpiryScheduler:
+    """Calls `callback(key)` once a key's deadline has passed.
+
+    One heap and one task handle the timeouts of every open questionnaire.
+    Rescheduling or cancelling a key leaves its old heap entry behind, which
+    is skipped when it reaches the top.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        self.deadlines = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if self.heap[0] == (deadline, key):
+            self.wakeup.set()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    async def run(self):
+        while True:
+            while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            asyncio.create_task(self.fire(key))
+
+    async def fire(self, key):
+        try:
+            await self.callback(key)
+        except Exception:
+            traceback.print_exc()
+
+
+def answer_lines(answer):
+    """The lines shown for an answer: its content, then a line per attachment."""
+    lines = [answer['content'] or "<No Message Content>"]
+    if answer['attachments']:
+        lines.append("")
+        lines.extend(f"`{attachment['filename']}`: {attachment['url']}" for attachment in answer['attachments'])
+    return lines
+
+
+def split_text(lines, limit):
+    """Join lines into chunks of at most `limit` characters, breaking between lines where possible."""
+    chunks = []
+    current = []
+    size = 0
+    for line in lines:
+        while len(line) > limit:
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and size + 1 + len(line) > limit:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        size += len(line) + (1 if current else 0)
+        current.append(line)
+    if current:
+        chunks.append("\n".join(current))
+    return chunks or ["\u200b"]
+
+
+class ResponseLayout:
+    """Lays out questions and answers over as many embeds as discord's limits require.
+
+    Long answers are split over continuation fields. A new embed is started
+    when the current one is out of fields or characters. The layout is built
+    in a single pass over the answers.
+    """
+    FIELD_NAME = 256
+    FIELD_VALUE = 1024
+    FIELDS = 25
+    EMBED_TOTAL = 6000
+    EMBEDS_PER_MESSAGE = 10
+    # discord applies the embed character limit to all embeds of a message together as well
+    MESSAGE_TOTAL = 6000
+
+    def __init__(self, color, author):
+        self.color = color
+        self.author = author
+        self.embeds = []
+        self.size = 0
+        self.total = 0
+        self.transcript = []
+
+    def new_embed(self):
+        em = discord.Embed(color=self.color, timestamp=datetime.utcnow())
+        self.size = 0
+        if not self.embeds:
+            em.set_author(name=self.author.name, icon_url=self.author.display_avatar.url)
+            self.size = len(self.author.name)
+            self.total += self.size
+        self.embeds.append(em)
+        return em
+
+    def add(self, question, answer):
+        lines = answer_lines(answer)
+        self.transcript.append(f"{question}\n" + "\n".join(lines))
+        name = question[:self.FIELD_NAME] or "\u200b"
+        for i, chunk in enumerate(split_text(lines, self.FIELD_VALUE)):
+            field_name = name if i == 0 else f"{name[:self.FIELD_NAME - 8]} (cont.)"
+            em = self.embeds[-1] if self.embeds else self.new_embed()
+            size = len(field_name) + len(chunk)
+            if len(em.fields) >= self.FIELDS or self.size + size > self.EMBED_TOTAL:
+                em = self.new_embed()
+            em.add_field(name=field_name, value=chunk, inline=False)
+            self.size += size
+            self.total += size
+
+    @property
+    def fits(self):
+        """Whether the embeds fit in a single message."""
+        return len(self.embeds) <= self.EMBEDS_PER_MESSAGE and self.total <= self.MESSAGE_TOTAL
+
+    def transcript_file(self):
+        return discord.File(BytesIO("\n\n".join(self.transcript).encode("utf-8")), filename="responses.txt")
+
+
+class Questionnaire:
+    """A recipient's progress through the questions of their thread."""
+    def __init__(self, thread, questions, move_to, q_message):
+        self.thread = thread
+        self.questions = questions
+        self.move_to = move_to
+        self.q_message = q_message
+        self.index = 0
+        self.responses = {}
+        # only messages sent after a question was asked count as its answer
+        self.waiting = False
+
+    @property
+    def question(self):
+        return self.questions[self.index]
+
+
 class Questions(commands.Cog):
     """Reaction-based menu for threads"""
     def __init__(self, bot):
         self.bot = bot
         self.db = self.bot.plugin_db.get_partition(self)
+        # open questionnaires by recipient id, advanced by on_message
+        self.sessions = {}
+        # recipients with saved progress from before a restart, loaded when they reply
+        self.saved = set()
+        self.expiry = ExpiryScheduler(self.on_timeout)
+        self.config = {}
+
+    async def cog_load(self):
+        await self.load_config()
+        self.poll_config.start()
+        async for doc in self.db.find({'_id': {'$regex': '^progress-'}}, {'deadline': 1}):
+            recipient_id = int(doc['_id'][len('progress-'):])
+            self.saved.add(recipient_id)
+            self.expiry.schedule(recipient_id, doc['deadline'])
+        self.expiry_starter = asyncio.create_task(self.start_expiry())
+
+    async def start_expiry(self):
+        # deadlines that passed while the bot was down fire right away, threads can only be found and closed once it's ready
+        await self.bot.wait_until_ready()
+        self.expiry.start()
+
+    async def cog_unload(self):
+        self.expiry_starter.cancel()
+        self.expiry.stop()
+        self.poll_config.cancel()
+
+    async def load_config(self):
+        self.config = await self.db.find_one({'_id': 'config'}) or {}
+
+    @tasks.loop(minutes=1)
+    async def poll_config(self):
+        """Reload the config if another bot process changed it, by only fetching its version."""
+        try:
+            doc = await self.db.find_one({'_id': 'config'}, {'version': 1}) or {}
+            if doc.get('version') != self.config.get('version'):
+                await self.load_config()
+        except Exception:
+            traceback.print_exc()
 
     def user_resp(self, channel, member, *, timeout=15):
         return self.bot.wait_for('message', check=lambda m: getattr(m.channel, 'recipient', m.channel) == channel and m.author == member, timeout=timeout)
@@ -22,50 +230,116 @@ class Questions(commands.Cog):
     @commands.Cog.listener()
     async def on_thread_ready(self, thread, creator, category, initial_message):
         """Sends out menu to user"""
-        config = await self.db.find_one({'_id': 'config'}) or {}
-        responses = {}
+        config = self.config
         if not config.get('questions'): return
-        print(config)
 
         q_message = DummyMessage(copy.copy(initial_message))
         q_message.author = self.bot.modmail_guild.me
 
-        for question in config['questions']:
-            print(question)
-            q_message.content = question
-            await thread.reply(q_message)
+        session = Questionnaire(thread, config['questions'], config['move_to'], q_message)
+        self.sessions[thread.recipient.id] = session
+        await self.db.find_one_and_update(
+            {'_id': f'progress-{thread.recipient.id}'},
+            {'$set': {'questions': session.questions, 'move_to': session.move_to, 'index': 0, 'answers': {}, 'deadline': time.time() + QUESTION_TIMEOUT}},
+            upsert=True,
+        )
+        await self.ask(session)
 
-            try:
-                m = await self.user_resp(thread.recipient, thread.recipient, timeout=15000)
-                print(m.content)
-            except asyncio.TimeoutError:
-                print("timeout")
-                await thread.close(closer=self.bot.modmail_guild.me, message='Closed due to inactivity and not responding to questions')
-                return
-            finally:
-                answer = m.content if m.content else "<No Message Content>"
-                answer += "\n"
-                if len(m.attachments) > 0:
-                    for attachment in m.attachments:
-                        answer += f"\n`{attachment.filename}`: {attachment.url}"
-
-                responses[question] = answer
-            print("looping")
-
-        await asyncio.sleep(1)
-        em = discord.Embed(color=self.bot.main_color, timestamp=datetime.utcnow())
-        for k, v in responses.items():
-            em.add_field(name=k, value=v, inline=False)
-        em.set_author(name=m.author.name, icon_url=m.author.avatar_url)
-        message = await thread.channel.send(embed=em)
-        await message.pin()
+    async def ask(self, session):
+        session.q_message.content = session.question
+        await session.thread.reply(session.q_message)
+        session.waiting = True
+        self.expiry.schedule(session.thread.recipient.id, time.time() + QUESTION_TIMEOUT)
+
+    async def restore(self, recipient_id):
+        """Rebuild a questionnaire that was in progress before a restart."""
+        self.saved.discard(recipient_id)
+        doc = await self.db.find_one({'_id': f'progress-{recipient_id}'})
+        thread = await self.bot.threads.find(recipient_id=recipient_id)
+        if doc is None or thread is None:
+            return None
+
+        q_message = DummyMessage(copy.copy(await thread.get_genesis_message()))
+        q_message.author = self.bot.modmail_guild.me
+        session = Questionnaire(thread, doc['questions'], doc['move_to'], q_message)
+        session.index = doc['index']
+        for i, answer in sorted(doc['answers'].items(), key=lambda item: int(item[0])):
+            session.responses[session.questions[int(i)]] = answer
+        # the current question was asked before the restart
+        session.waiting = True
+        self.sessions[recipient_id] = session
+        return session
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.author.bot or message.guild is not None:
+            return
+        session = self.sessions.get(message.author.id)
+        if session is None and message.author.id in self.saved:
+            session = await self.restore(message.author.id)
+        if session is None or not session.waiting:
+            return
+        session.waiting = False
 
-        q_message.content = 'Your appeal will now be reviewed by our moderation team. If you have new information to share about this case, please reply to this message.'
-        await thread.reply(q_message)
+        answer = {
+            'content': message.content,
+            'attachments': [{'filename': attachment.filename, 'url': attachment.url} for attachment in message.attachments],
+        }
+        session.responses[session.question] = answer
+        session.index += 1
 
-        move_to = self.bot.get_channel(int(config['move_to']))
-        print(move_to)
-        await thread.channel.edit(category=move_to, sync_permissions=True)
+        if session.index < len(session.questions):
+            # the answer is saved together with the checkpoint for the next question
+            await self.db.find_one_and_update(
+                {'_id': f'progress-{message.author.id}'},
+                {'$set': {f'answers.{session.index - 1}': answer, 'index': session.index, 'deadline': time.time() + QUESTION_TIMEOUT}},
+            )
+            await self.ask(session)
+            return
+
+        del self.sessions[message.author.id]
+        self.expiry.cancel(message.author.id)
+        await self.db.delete_one({'_id': f'progress-{message.author.id}'})
+        await self.finish(session, message.author)
+
+    async def on_timeout(self, recipient_id):
+        session = self.sessions.pop(recipient_id, None)
+        thread = session.thread if session is not None else await self.bot.threads.find(recipient_id=recipient_id)
+        if thread is not None:
+            await thread.close(closer=self.bot.modmail_guild.me, message='Closed due to inactivity and not responding to questions')
+        # only forget the questionnaire once its thread is closed, so a failed close is retried after a restart
+        self.saved.discard(recipient_id)
+        await self.db.delete_one({'_id': f'progress-{recipient_id}'})
+
+    async def finish(self, session, author):
+        """Post the answers, tell the user and move the thread, all at the same time."""
+        thread = session.thread
+        session.q_message.content = 'Your appeal will now be reviewed by our moderation team. If you have new information to share about this case, please reply to this message.'
+        move_to = self.bot.get_channel(int(session.move_to))
+
+        # independent steps, a failing one doesn't stop the others
+        results = await asyncio.gather(
+            self.post_responses(session, author),
+            thread.reply(session.q_message),
+            thread.channel.edit(category=move_to, sync_permissions=True),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                traceback.print_exception(type(result), result, result.__traceback__)
+
+    async def post_responses(self, session, author):
+        layout = ResponseLayout(self.bot.main_color, author)
+        for k, v in session.responses.items():
+            layout.add(k, v)
+        if layout.fits:
+            message = await session.thread.channel.send(embeds=layout.embeds)
+        else:
+            # too long for one message, attach the answers as a file instead
+            em = discord.Embed(color=self.bot.main_color, timestamp=datetime.utcnow(), description="The answers are too long to show here, see the attached file.")
+            em.set_author(name=author.name, icon_url=author.display_avatar.url)
+            message = await session.thread.channel.send(embed=em, file=layout.transcript_file())
+        await message.pin()
 
     @checks.has_permissions(PermissionLevel.MODERATOR)
     @commands.command()
@@ -94,7 +368,12 @@ class Questions(commands.Cog):
                 return await ctx.send('Timed out.')
             questions.append(m.content)
 
-        await self.db.find_one_and_update({'_id': 'config'}, {'$set': {'questions': questions, 'move_to': str(move_to.id)}}, upsert=True)
+        self.config = await self.db.find_one_and_update(
+            {'_id': 'config'},
+            {'$set': {'questions': questions, 'move_to': str(move_to.id)}, '$inc': {'version': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
         await ctx.send('Saved')
 
 